@@ -7,6 +7,8 @@ import time
 import struct
 import argparse
 import platform
+import threading
+from binascii import crc_hqx
 
 
 import pyprind
@@ -25,17 +27,9 @@ CMD_GET_MAC  = 0x38
 CMD_GET_QFID = 0x3c # ROM boot only
 CMD_ERASE_SECBOOT = 0x3f
 
-# CRC-16/CCITT-FALSE
+# CRC-16/CCITT-FALSE: crc_hqx is poly 0x1021, no reflection, no xor-out
 def crc16(data : bytearray):
-    crc = 0xFFFF
-    for i in range(0, len(data)):
-        crc ^= data[i] << 8
-        for j in range(0,8):
-            if (crc & 0x8000) > 0:
-                crc =(crc << 1) ^ 0x1021
-            else:
-                crc = crc << 1
-    return crc & 0xFFFF
+    return crc_hqx(data, 0xFFFF)
 
 def putc(c):
     sys.stdout.write(c)
@@ -53,24 +47,45 @@ def deviceHardReset():
     ser.setRTS(False)
 
 def deviceWaitBoot(timeout = 3):
-    ser.timeout = 0.01
+    ser.timeout = 0.05
     ser.flushInput()
-    started = time.time()
+    started = time.monotonic()
+    probed = 0
     buff = b''
-    while time.time() - started < timeout:
-        ser.write(b'\x1B')
-        buff = buff + ser.read(1)
+    while time.monotonic() - started < timeout:
+        now = time.monotonic()
+        if now - probed >= 0.05:     # Keep sending ESC to stop autoboot
+            ser.write(b'\x1B')
+            probed = now
+        n = ser.in_waiting
+        buff = buff + (ser.read(n) if n else ser.read(1))
         buff = buff[-16:]            # Remember last 16 chars
         if buff.endswith(b'CCCC'):
             return True
     return False
 
+# Frame buffer reused by sendCommand: 5 byte header + command
+_FRAME = bytearray(64)
+
 def sendCommand(cmd):
-    cmd = struct.pack('<BHH', 0x21, len(cmd)+2, crc16(cmd)) + cmd
+    n = len(cmd) + 5
+    struct.pack_into('<BHH', _FRAME, 0, 0x21, len(cmd)+2, crc16(cmd))
+    _FRAME[5:n] = cmd
     ser.flushInput()
-    ser.write(cmd)
+    ser.write(memoryview(_FRAME)[:n])
     ser.flush()
-    #print('<<< ', cmd.hex())
+    #print('<<< ', _FRAME[:n].hex())
+
+def readLine(max_len = 128):
+    # Take what is already buffered and only block while the line is
+    # incomplete; an empty read means ser.timeout expired.
+    buff = ser.read(ser.in_waiting or 1)
+    while buff and b'\n' not in buff and len(buff) < max_len:
+        chunk = ser.read(ser.in_waiting or 1)
+        if not chunk:
+            break
+        buff += chunk
+    return buff.split(b'\n', 1)[0]
 
 def deviceSetBaud(baud):
     prev_baud = ser.baudrate
@@ -78,10 +93,14 @@ def deviceSetBaud(baud):
     def serialSetBaud(value):
         if ser.baudrate == value:
             return
-        ser.close()
-        ser.baudrate = value
-        ser.open()
-        time.sleep(0.1)
+        try:
+            ser.baudrate = value     # Most drivers switch on the open port
+        except (ValueError, serial.SerialException):
+            ser.close()
+            ser.baudrate = value
+            ser.open()
+            time.sleep(0.1)
+        ser.flushInput()
 
     for retry in range(3):
         serialSetBaud(prev_baud)
@@ -114,7 +133,7 @@ def deviceSetMAC(mac):
 def deviceGetMAC():
     ser.timeout = 1
     sendCommand(struct.pack('<I', CMD_GET_MAC))
-    result = ser.read_until(b'\n')
+    result = readLine()
     result = result.decode('ascii').upper().strip()
     if result.startswith('MAC:'):
         return result[4:]
@@ -123,7 +142,7 @@ def deviceGetMAC():
 def deviceGetFlashID():
     ser.timeout = 1
     sendCommand(struct.pack('<I', CMD_GET_QFID))
-    result = ser.read_until(b'\n')
+    result = readLine()
     result = result.decode('ascii').upper().strip()
     if result.startswith('FID:'):
         return result[4:]
@@ -134,18 +153,39 @@ def deviceUploadFile(fn):
     statinfo_bin = os.stat(fn)
     bar = pyprind.ProgBar(statinfo_bin.st_size, bar_char='═')
 
+    # XMODEM passes a timeout which pyserial's read/write do not take,
+    # so these stay, but only as plain forwarders.
     def ser_write(data, timeout=1):
-        bar.update(1024)
         return ser.write(data)
 
     def ser_read(size, timeout=1):
         return ser.read(size)
 
     stream = open(fn, 'rb+')
+    done = threading.Event()
+
+    # Report progress from the file position XMODEM has read up to,
+    # at most every 100 ms, keeping the bar out of the packet path.
+    def progress_poll():
+        shown = 0
+        while True:
+            stopped = done.wait(0.1)
+            pos = stream.tell()
+            if pos > shown:
+                bar.update(pos - shown)
+                shown = pos
+            if stopped:
+                return
+
     time.sleep(0.2)
     modem = XMODEM1k(ser_read, ser_write)
     ser.flushInput()
-    if modem.send(stream):
+    poller = threading.Thread(target=progress_poll, daemon=True)
+    poller.start()
+    result = modem.send(stream)
+    done.set()
+    poller.join()
+    if result:
         time.sleep(1)
         reply = ser.read_until(b'run user code...')
         reply = reply.decode('ascii').strip()